@@ -16,5 +16,6 @@ def export_name(fn):
     return fn
 
 
+from .groupcommit import *
 from .mongokitmanager import *
 from .restmixins import *
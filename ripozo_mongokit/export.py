@@ -0,0 +1,82 @@
+"""
+Helpers for the parallel MongoKitManager export
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import json
+import logging
+
+import six
+from mongokit import Connection
+
+_logger = logging.getLogger(__name__)
+
+
+def get_range_query(query, field, lower, upper):
+    """
+    Restricts the query to the [lower, upper) range of the field.
+    None bounds leave the range open on that side.
+
+    :param dict query: Mongo query
+    :param string field: partition field
+    :return: dict: Mongo query of the range
+    """
+    bounds = {}
+    if lower is not None:
+        bounds['$gte'] = lower
+    if upper is not None:
+        bounds['$lt'] = upper
+    if not bounds:
+        return query
+    if not query:
+        return {field: bounds}
+    return {'$and': [query, {field: bounds}]}
+
+
+def get_other_types_query(query, field, split_point):
+    """
+    Matches the documents none of the split point ranges contain: the
+    ones whose field is null, missing or of a type that can not be
+    compared with the split point, as Mongo range operators only match
+    values of the same type.
+
+    :param dict query: Mongo query
+    :param string field: partition field
+    :param split_point: any of the split points
+    :return: dict: Mongo query of the remaining documents
+    """
+    other_types = {'$nor': [{field: {'$gte': split_point}}, {field: {'$lt': split_point}}]}
+    if not query:
+        return other_types
+    return {'$and': [query, other_types]}
+
+
+def export_partition(task):
+    """
+    Process pool worker. Opens its own connection, reads one range of
+    the collection and writes it as NDJSON to the partition file.
+
+    :param tuple task: (manager class, connection uri, connection
+        options, query, path)
+    :return: tuple(string, int): partition file path and document count
+    """
+    manager_class, uri, options, query, path = task
+    connection = Connection(uri, **options)
+    try:
+        manager = manager_class(connection=connection)
+        count = 0
+        with io.open(path, 'w', encoding='utf-8') as out:
+            for obj in manager.collection.find(query):
+                line = json.dumps(manager._serialize_model(obj), default=six.text_type)
+                out.write(six.text_type(line))
+                out.write('\n')
+                count += 1
+    finally:
+        connection.close()
+    _logger.debug('Exported %s documents to %s', count, path)
+    return path, count
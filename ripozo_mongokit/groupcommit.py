@@ -0,0 +1,238 @@
+"""
+GroupCommitWriter
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import logging
+import threading
+import time
+
+from bson import ObjectId
+from ripozo.exceptions import ManagerException
+from six.moves import queue
+
+from ripozo_mongokit import export_name
+
+_logger = logging.getLogger(__name__)
+
+
+class _PendingWrite(object):
+    """
+    A document waiting in the GroupCommitWriter queue together with
+    the outcome of its write.
+    """
+    def __init__(self, document):
+        self.document = document
+        # Documents with a client supplied _id can not be told apart
+        # after a partially failed batch, so they are written alone.
+        self.generated_id = '_id' not in document
+        if self.generated_id:
+            document['_id'] = ObjectId()
+        self.error = None
+        self.done = threading.Event()
+        # Both are guarded by the writer state lock: a write is either
+        # cancelled by its timed out caller or started by the flush.
+        self.cancelled = False
+        self.started = False
+
+    def finish(self, error=None):
+        self.error = error
+        self.done.set()
+
+
+@export_name
+class GroupCommitWriter(object):
+    """
+    Collects documents written by concurrent requests and inserts them
+    with a single bulk insert. Every caller blocks until the batch that
+    contains its document is acknowledged and gets its own error if the
+    document could not be written.
+
+    :param collection: pymongo collection to insert the documents into.
+    :param int flush_interval: maximum time in milliseconds a document
+        waits for other documents before the batch is flushed.
+    :param int batch_size: maximum number of documents in one batch.
+    :param int max_queue_size: maximum number of queued documents. Writers
+        block when the queue is full.
+    :param float queue_timeout: seconds a writer waits for a free queue
+        slot before the write is rejected with a 503 ManagerException.
+        None waits forever.
+    :param dict write_concern: write concern arguments passed to insert(),
+        e.g. {'w': 1, 'j': True}.
+    :param float ack_timeout: seconds a queued writer waits for the
+        acknowledgement. A write that is still queued by then is cancelled,
+        it is never inserted and the caller gets a 503 ManagerException.
+        A write already being inserted is waited for once more; if it is
+        still not acknowledged the caller gets a 504 ManagerException as
+        its outcome is unknown. Defaults to the flush interval plus the
+        'wtimeout' of the write concern plus five seconds for the insert
+        round trip.
+    """
+
+    def __init__(self, collection, flush_interval=10, batch_size=100,
+                 max_queue_size=1000, queue_timeout=1, write_concern=None,
+                 ack_timeout=None):
+        self.collection = collection
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.queue_timeout = queue_timeout
+        self.write_concern = write_concern or {}
+        if ack_timeout is None:
+            ack_timeout = (flush_interval + self.write_concern.get('wtimeout', 0)) / 1000 + 5
+        self.ack_timeout = ack_timeout
+
+        self._queue = queue.Queue(max_queue_size)
+        self._lock = threading.Lock()
+        self._state_lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+
+    def write(self, document):
+        """
+        Queues the document and waits until it is written.
+
+        :param dict document: document to insert. An _id is added to it
+            if it does not have one.
+        :return: dict: the written document
+        :raises: ManagerException if the writer is closed, the queue is
+            full or the write is not acknowledged in time (503 when it was
+            cancelled, 504 when its outcome is unknown), or the error
+            raised while inserting the document.
+        """
+        self._start()
+        pending = _PendingWrite(document)
+        try:
+            self._queue.put(pending, timeout=self.queue_timeout)
+        except queue.Full:
+            raise ManagerException('Write queue is full, try again later', status_code=503)
+        if not pending.done.wait(self.ack_timeout):
+            with self._state_lock:
+                pending.cancelled = not pending.started
+            if pending.cancelled:
+                _logger.warning('Document %s was not written within %s seconds, cancelled',
+                                document['_id'], self.ack_timeout)
+                raise ManagerException('Write was not acknowledged in time, try again later',
+                                       status_code=503)
+            if not pending.done.wait(self.ack_timeout):
+                _logger.warning('Insert of document %s is not acknowledged, outcome unknown',
+                                document['_id'])
+                raise ManagerException('Write outcome is unknown', status_code=504)
+        if pending.error is not None:
+            raise pending.error
+        return document
+
+    def close(self):
+        """
+        Flushes the queued documents and stops the writer thread. Writes
+        queued behind the shutdown are rejected.
+        """
+        with self._lock:
+            self._closed = True
+            if self._thread is None:
+                return
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+            self._reject_queued()
+
+    def _start(self):
+        with self._lock:
+            if self._closed:
+                raise ManagerException('Writer is closed', status_code=503)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='GroupCommitWriter')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            pending = self._queue.get()
+            if pending is None:
+                return
+            batch = [pending]
+            deadline = time.time() + self.flush_interval / 1000
+            stop = False
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    pending = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if pending is None:
+                    stop = True
+                    break
+                batch.append(pending)
+            self._flush(batch)
+            if stop:
+                return
+
+    def _reject_queued(self):
+        while True:
+            try:
+                pending = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if pending is not None:
+                pending.finish(ManagerException('Writer is closed', status_code=503))
+
+    def _flush(self, batch):
+        """
+        Inserts a batch of documents and reports the outcome to each
+        of the waiting writers. Writes cancelled by their callers are
+        dropped.
+        """
+        with self._state_lock:
+            batch = [pending for pending in batch if not pending.cancelled]
+            for pending in batch:
+                pending.started = True
+        grouped = [pending for pending in batch if pending.generated_id]
+        for pending in batch:
+            if not pending.generated_id:
+                self._insert_one(pending)
+        if not grouped:
+            return
+
+        try:
+            self.collection.insert([pending.document for pending in grouped],
+                                   **self.write_concern)
+        except Exception as e:
+            _logger.warning('Group commit of %s documents failed: %s', len(grouped), e)
+            self._recover(grouped, e)
+        else:
+            for pending in grouped:
+                pending.finish()
+
+    def _recover(self, grouped, error):
+        """
+        The insert is ordered, so a failed batch may be partially written.
+        Documents found by their generated _id succeeded, the remaining
+        ones are retried one by one to get their own result.
+        """
+        ids = [pending.document['_id'] for pending in grouped]
+        try:
+            written = set(obj['_id'] for obj in self.collection.find(
+                {'_id': {'$in': ids}}, fields=['_id']))
+        except Exception:
+            for pending in grouped:
+                pending.finish(error)
+            return
+
+        for pending in grouped:
+            if pending.document['_id'] in written:
+                pending.finish()
+            else:
+                self._insert_one(pending)
+
+    def _insert_one(self, pending):
+        try:
+            self.collection.insert(pending.document, **self.write_concern)
+        except Exception as e:
+            pending.finish(e)
+        else:
+            pending.finish()
@@ -8,24 +8,76 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import abc
+import copy
+import functools
 import logging
+import threading
 
 import datetime
 import six
 import math
+import io
 import json
+import os
+import shutil
+import tempfile
+from multiprocessing import Pool, cpu_count
 
 from bson import ObjectId
 from bson.errors import InvalidId
 from mongokit import Connection
+from mongokit.mongo_exceptions import MaxDocumentSizeError
+from mongokit.schema_document import SchemaDocumentError
+from pymongo.errors import ExecutionTimeout, OperationFailure
+from ripozo.exceptions import ManagerException, NotFoundException, ValidationException
 from ripozo.manager_base import BaseManager
 from ripozo.resources.fields import IntegerField
+from ripozo.resources.fields.validations import translate_iterable_to_single
 
 from ripozo_mongokit import export_name
+from ripozo_mongokit.export import export_partition, get_other_types_query, get_range_query
 from ripozo_mongokit.fields import SortField
+from ripozo_mongokit.groupcommit import GroupCommitWriter
 
 _logger = logging.getLogger(__name__)
 
+# Concurrency limiters shared by all the managers of a collection
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def _guard(fn):
+    """
+    Wraps a manager operation with its time budget and the load shedding
+    limiter of the collection. A 'max_time_ms' keyword argument overrides
+    the budget of the call. Nested operations run within the budget and
+    the limiter slot of the outermost one.
+    """
+    @functools.wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        max_time_ms = kwargs.pop('max_time_ms', None)
+        if getattr(self._local, 'active', False):
+            return fn(self, *args, **kwargs)
+
+        if max_time_ms is None:
+            max_time_ms = self.operation_max_time_ms.get(fn.__name__, self.max_time_ms)
+        if self._limiter is not None and not self._limiter.acquire(False):
+            raise ManagerException('Too many concurrent requests, try again later',
+                                   status_code=503)
+        self._local.active = True
+        self._local.max_time_ms = max_time_ms
+        try:
+            return fn(self, *args, **kwargs)
+        except ExecutionTimeout:
+            _logger.warning('%s exceeded the time budget of %s ms', fn.__name__, max_time_ms)
+            raise ManagerException('The operation exceeded its time budget', status_code=504)
+        finally:
+            self._local.active = False
+            self._local.max_time_ms = None
+            if self._limiter is not None:
+                self._limiter.release()
+    return wrapper
+
 
 @export_name
 class MongoKitManager(six.with_metaclass(abc.ABCMeta, BaseManager)):
@@ -47,10 +99,61 @@ class MongoKitManager(six.with_metaclass(abc.ABCMeta, BaseManager)):
         by searching for the request parameters of the '*<regex_suffix>'
         format.
 
+    :param string compact_query_arg: query arg that selects the compact
+        'rows' or 'columns' representation of retrieve_list.
+
     :param string database_name:
     :param string collection_name: database and collection name
         params override corrspondent parameters of the Model document
         class.
+
+    :param dict prefetch_relationships: maps a property name to a
+        (foreign_key, related_manager) tuple. The related manager may be
+        a MongoKitManager class or instance. When a list of entities is
+        retrieved, the foreign keys of the whole list are resolved with a
+        single '$in' query per related manager and the related entities
+        are placed under the property name, so that ripozo relationships
+        can be rendered without a lookup per entity.
+
+    :param bool group_commit: if True, creates from concurrent requests
+        are collected by a GroupCommitWriter and written with one bulk
+        insert. Creates with a client supplied '_id' are written alone.
+    :param int group_commit_interval: milliseconds a create waits for
+        other creates before the batch is written.
+    :param int group_commit_size: maximum number of documents per batch.
+    :param int group_commit_queue_size: maximum number of queued creates.
+    :param float group_commit_queue_timeout: seconds a create waits for a
+        free queue slot before it is rejected with a 503 error.
+    :param dict group_commit_write_concern: write concern of the group
+        commit inserts.
+    :param float group_commit_ack_timeout: seconds a create waits for its
+        batch to be acknowledged. A document still queued by then is never
+        inserted and the create fails with a 503 error, one already being
+        inserted fails with a 504 error as its outcome is unknown. None
+        derives it from the interval and the write concern 'wtimeout'.
+
+    :param string export_partition_field: indexed, single valued field
+        the collection is split on by export(). The split points come
+        from the splitVector command on its index.
+    :param string export_connection_uri:
+    :param dict export_connection_options: MongoDB URI and Connection
+        keyword arguments the export() workers connect with. They should
+        carry the replica set, authentication and SSL settings of the
+        manager connection, which can not be read back from it.
+
+    :param string version_field: document version field used for the
+        optimistic concurrency control of updates. None disables it.
+
+    :param int max_time_ms: time budget of the finds, counts and updates
+        of every operation, applied as maxTimeMS. Operations exceeding it
+        fail with a 504 error.
+    :param dict operation_max_time_ms: per operation time budgets, keyed
+        by the operation name (e.g. 'retrieve_list').
+    :param int max_concurrent_operations: maximum number of operations
+        running at once on the collection. Excess requests are rejected
+        with a 503 error instead of being queued. The limit is shared by
+        all the managers of the collection, a manager with a different
+        limit than the others raises a ValueError when it is created.
     """
     all_fields = True
     exclude_fields = tuple()
@@ -60,6 +163,7 @@ class MongoKitManager(six.with_metaclass(abc.ABCMeta, BaseManager)):
     page_query_arg = 'page'
     page_size_query_arg = 'size'
     sort_query_arg = 'sort'
+    compact_query_arg = 'compact'
 
     regex_suffix = 'Regex'
 
@@ -72,6 +176,26 @@ class MongoKitManager(six.with_metaclass(abc.ABCMeta, BaseManager)):
     # Indicates that the ripozo_mongokit.RetrievePageList mixin is used.
     page_properties = False
 
+    prefetch_relationships = {}
+
+    group_commit = False
+    group_commit_interval = 10
+    group_commit_size = 100
+    group_commit_queue_size = 1000
+    group_commit_queue_timeout = 1
+    group_commit_write_concern = None
+    group_commit_ack_timeout = None
+
+    export_partition_field = '_id'
+    export_connection_uri = None
+    export_connection_options = None
+
+    version_field = None
+
+    max_time_ms = None
+    operation_max_time_ms = {}
+    max_concurrent_operations = None
+
     _connection = None
 
     def __init__(self, connection=None, *args, **kwargs):
@@ -86,6 +210,19 @@ class MongoKitManager(six.with_metaclass(abc.ABCMeta, BaseManager)):
             self.model.__database__ = self.database_name
         self.connection.register([self.model])
         self.collection = getattr(self.connection, self.model.__name__)
+        self._related_managers = {}
+        self._local = threading.local()
+        self._limiter = self._get_limiter()
+
+        self.writer = None
+        if self.group_commit:
+            self.writer = GroupCommitWriter(self.collection.collection,
+                                            flush_interval=self.group_commit_interval,
+                                            batch_size=self.group_commit_size,
+                                            max_queue_size=self.group_commit_queue_size,
+                                            queue_timeout=self.group_commit_queue_timeout,
+                                            write_concern=self.group_commit_write_concern,
+                                            ack_timeout=self.group_commit_ack_timeout)
 
     @abc.abstractproperty
     def model(self):
@@ -203,6 +340,135 @@ class MongoKitManager(six.with_metaclass(abc.ABCMeta, BaseManager)):
 
         return self._serialize_model_helper(model)
 
+    def _get_limiter(self):
+        """
+        :return: the concurrency limiter shared by the managers of the
+            collection, None if max_concurrent_operations is not set.
+        :raises: ValueError if another manager of the collection already
+            uses a different limit.
+        """
+        if not self.max_concurrent_operations:
+            return None
+        key = (self.model.__database__, self.model.__collection__)
+        with _limiters_lock:
+            if key not in _limiters:
+                _limiters[key] = (self.max_concurrent_operations,
+                                  threading.BoundedSemaphore(self.max_concurrent_operations))
+            limit, limiter = _limiters[key]
+        if limit != self.max_concurrent_operations:
+            raise ValueError('max_concurrent_operations of %s.%s is already set to %s'
+                             % (key[0], key[1], limit))
+        return limiter
+
+    def _find(self, *args, **kwargs):
+        """
+        Collection find() bounded by the time budget of the operation.
+        The budget applies to count() of the cursor too.
+        """
+        cursor = self.collection.find(*args, **kwargs)
+        max_time_ms = getattr(self._local, 'max_time_ms', None)
+        if max_time_ms is not None:
+            cursor = cursor.max_time_ms(max_time_ms)
+        return cursor
+
+    def _find_one(self, *args, **kwargs):
+        max_time_ms = getattr(self._local, 'max_time_ms', None)
+        if max_time_ms is not None:
+            kwargs['max_time_ms'] = max_time_ms
+        return self.collection.find_one(*args, **kwargs)
+
+    def _find_and_modify(self, *args, **kwargs):
+        max_time_ms = getattr(self._local, 'max_time_ms', None)
+        if max_time_ms is not None:
+            kwargs['maxTimeMS'] = max_time_ms
+        return self.collection.find_and_modify(*args, **kwargs)
+
+    def _get_related_manager(self, manager):
+        """
+        Returns the instance of a related manager. Manager classes are
+        instantiated once with the connection of this manager.
+
+        :param manager: MongoKitManager class or instance
+        :return: MongoKitManager instance
+        """
+        if isinstance(manager, MongoKitManager):
+            return manager
+        if manager not in self._related_managers:
+            self._related_managers[manager] = manager(connection=self.connection)
+        return self._related_managers[manager]
+
+    def retrieve_by_keys(self, keys, field='_id', max_time_ms=None):
+        """
+        Retrieves all the documents whose field matches one of the keys
+        with a single '$in' query.
+
+        :param keys: iterable of the raw field values. String keys of
+            the '_id' field are converted to ObjectId when possible.
+        :param string field: field name to match the keys against
+        :param int max_time_ms: time budget of the query, defaults to
+            the budget of the running operation or max_time_ms.
+        :return: dict: serialized documents keyed by the text
+            representation of the field value
+        """
+        values = []
+        for key in keys:
+            if field == '_id' and isinstance(key, six.string_types):
+                try:
+                    key = ObjectId(key)
+                except InvalidId:
+                    pass
+            values.append(key)
+        if not values:
+            return {}
+
+        if max_time_ms is None:
+            max_time_ms = getattr(self._local, 'max_time_ms', None) or self.max_time_ms
+        cursor = self.collection.find({field: {'$in': values}})
+        if max_time_ms is not None:
+            cursor = cursor.max_time_ms(max_time_ms)
+
+        documents = {}
+        for obj in cursor:
+            key = six.text_type(obj.get(field))
+            documents[key] = self._serialize_model(obj)
+        return documents
+
+    def _prefetch(self, values):
+        """
+        Resolves prefetch_relationships for a list of documents before
+        they are serialized, so excluded foreign keys can be resolved too.
+        Runs one query per related manager regardless of the list length.
+        The raw foreign key values are queried, their text representation
+        is only used to match the results. The queries run within the time
+        budget of the current operation.
+
+        :param list values: documents, updated in place with the
+            serialized related entities
+        :return: list: the same documents
+        """
+        for name, (foreign_key, manager) in six.iteritems(self.prefetch_relationships):
+            keys = {}
+            for obj in values:
+                key = obj.get(foreign_key)
+                if isinstance(key, (list, tuple, set)):
+                    keys.update((six.text_type(k), k) for k in key if k is not None)
+                elif key is not None:
+                    keys[six.text_type(key)] = key
+            if not keys:
+                continue
+
+            related = self._get_related_manager(manager).retrieve_by_keys(
+                list(keys.values()), max_time_ms=getattr(self._local, 'max_time_ms', None))
+            for obj in values:
+                key = obj.get(foreign_key)
+                if isinstance(key, (list, tuple, set)):
+                    obj[name] = [related[six.text_type(k)] for k in key
+                                 if six.text_type(k) in related]
+                elif key is not None:
+                    obj[name] = related.get(six.text_type(key))
+        return values
+
+    @_guard
     def create(self, values, *args, **kwargs):
         """
         Creates a new instance of a model object and saves it int the database.
@@ -211,9 +477,24 @@ class MongoKitManager(six.with_metaclass(abc.ABCMeta, BaseManager)):
         :return: dict: serialized created document
         """
         model_document = self.collection.from_json(json.dumps(values))
-        model_document.save()
+        if self.writer is None:
+            model_document.save()
+        else:
+            self._group_commit(model_document)
         return self._serialize_model(model_document)
 
+    def _group_commit(self, model_document):
+        """
+        Validates the document the same way save() does and hands it
+        over to the group commit writer.
+        """
+        if not model_document.skip_validation:
+            model_document.validate()
+        model_document._process_custom_type('bson', model_document, model_document.structure)
+        self.writer.write(model_document)
+        model_document._process_custom_type('python', model_document, model_document.structure)
+
+    @_guard
     def retrieve(self, lookup_keys, *args, **kwargs):
         """
         Retrieves a document according to the lookup_keys filters.
@@ -226,9 +507,10 @@ class MongoKitManager(six.with_metaclass(abc.ABCMeta, BaseManager)):
         query = self._get_query(lookup_keys)
         if 'query' in kwargs:
             query.update(kwargs['query'])
-        model_document = self.collection.find_one(query)
+        model_document = self._find_one(query)
         return self._serialize_model(model_document)
 
+    @_guard
     def retrieve_all(self, filters, *args, **kwargs):
         """
         Gets all entities according to filters without pagination.
@@ -242,13 +524,14 @@ class MongoKitManager(six.with_metaclass(abc.ABCMeta, BaseManager)):
         query = self._get_query(filters)
         if 'query' in kwargs:
             query.update(kwargs['query'])
-        cursor = self.collection.find(query)
+        cursor = self._find(query)
         count = cursor.count()
 
-        values = [self._serialize_model(obj) for obj in cursor]
+        values = [self._serialize_model(obj) for obj in self._prefetch(list(cursor))]
 
         return values, dict(count=count)
 
+    @_guard
     def retrieve_list(self, filters, *args, **kwargs):
         """
         Retrieves the list of documents according to the filters provided.
@@ -257,9 +540,13 @@ class MongoKitManager(six.with_metaclass(abc.ABCMeta, BaseManager)):
 
         :param dict filters: pagination and query filters.
         :param kwargs: if kwargs dict contains a 'query' argument it is
-            treated as ready MongoDB query dict.
+            treated as ready MongoDB query dict. A 'compact' argument
+            ('rows' or 'columns') selects the compact representation
+            when the compact query arg is not given.
         :return: tuple(list(dict)), dict): serialized structure, containing
-            retrieved list of entities and a piece of metadata
+            retrieved list of entities and a piece of metadata. In the
+            compact representation the data is a dict with the field
+            names and either the 'rows' or the 'columns' arrays.
         """
 
         translator = IntegerField('tmp')
@@ -272,11 +559,24 @@ class MongoKitManager(six.with_metaclass(abc.ABCMeta, BaseManager)):
 
         sort_tuple = SortField('sort').translate(filters.pop(self.sort_query_arg, None))
 
+        compact = translate_iterable_to_single(
+            filters.pop(self.compact_query_arg, kwargs.get('compact')))
+        if compact not in (None, 'rows', 'columns'):
+            raise ValidationException('Not a valid compact format: %s' % compact)
+        fields = self._get_compact_fields() if compact else None
+
         query = self._get_query(filters)
         if 'query' in kwargs:
             query.update(kwargs['query'])
-        cursor = self.collection.find(query).sort(sort_tuple[0], sort_tuple[1]) \
-            if sort_tuple else self.collection.find(query)
+        find_kwargs = {}
+        if fields:
+            projection = set(field for field in fields if field != self.id_field and
+                             field not in self.prefetch_relationships)
+            projection.update(foreign_key for foreign_key, manager
+                              in six.itervalues(self.prefetch_relationships))
+            find_kwargs['fields'] = sorted(projection)
+        cursor = self._find(query, **find_kwargs).sort(sort_tuple[0], sort_tuple[1]) \
+            if sort_tuple else self._find(query, **find_kwargs)
         count = cursor.count()
         page_count = int(math.ceil(count / page_size))
 
@@ -305,7 +605,10 @@ class MongoKitManager(six.with_metaclass(abc.ABCMeta, BaseManager)):
             last_link = {self.page_query_arg: page_count - 1,
                          self.page_size_query_arg: page_size}
 
-        values = self._serialize_model([obj for obj in cursor.skip(query_skip).limit(query_limit)])
+        values = self._prefetch([obj for obj in cursor.skip(query_skip).limit(query_limit)])
+        values = self._serialize_model(values)
+        if compact:
+            values = self._compact(values, fields, compact)
         page_object = dict(page=dict(size=page_size,
                                      totalElements=count,
                                      totalPages=page_count,
@@ -315,25 +618,181 @@ class MongoKitManager(six.with_metaclass(abc.ABCMeta, BaseManager)):
                                                                            first=first_link,
                                                                            last=last_link))
 
-    def update(self, filters, updates, *args, **kwargs):
+    def _get_compact_fields(self):
+        """
+        Field names of the compact representation: the id, the model
+        structure fields that are not excluded and the prefetched
+        relationships. None if the structure has no fixed field names.
 
+        :return: list: field names
         """
-        Retrieves the entities from the database according to the filters.
+        structure = getattr(self.model, 'structure', None) or {}
+        if not all(isinstance(key, six.string_types) for key in structure):
+            return None
+        fields = sorted(key for key in structure
+                        if key not in self.exclude_fields and key != self.id_field)
+        return [self.id_field] + fields + sorted(self.prefetch_relationships)
 
-        :param updates: dict with the values for the new entity
-        :return: dict
-        :raises: SchemaTypeError
+    @staticmethod
+    def _compact(values, fields, compact):
         """
-        query = self._get_query(updates)
-        model_documents = self.collection.find(query)
-        model_list = list()
-        for model_document in model_documents:
-            model_document.update(updates)
-            model_document.save()
-            model_list.append(self._serialize_model(model_document))
+        Converts serialized entities into the compact representation.
+
+        :param list values: serialized entities
+        :param list fields: field names, None to collect them from the
+            entities
+        :param string compact: 'rows' for an array per entity, 'columns'
+            for an array per field
+        :return: dict: field names and rows or columns
+        """
+        if fields is None:
+            fields = sorted(set(key for obj in values for key in obj))
+        if compact == 'columns':
+            return dict(fields=fields,
+                        columns=[[obj.get(field) for obj in values] for field in fields])
+        return dict(fields=fields,
+                    rows=[[obj.get(field) for field in fields] for obj in values])
+
+    @_guard
+    def update(self, lookup_keys, updates, *args, **kwargs):
+        """
+        Updates the document found with the lookup keys with a single
+        atomic find_and_modify. The changes are validated against the
+        stored document like save() does, and only the changed fields are
+        sent to the database as a $set/$unset diff.
+
+        When version_field is defined the update is guarded by the
+        document version: the version sent by the client, or else the
+        stored one, must match and it is incremented on every write.
+
+        :param lookup_keys: query keys of the document to update
+        :param dict updates: the fields to update and their new values
+        :param bool full: if True the updates are the full new state of
+            the document, fields missing from it are unset. Otherwise
+            only the given fields are set.
+        :return: dict: serialized updated document
+        :raises: NotFoundException if the document does not exist
+        :raises: ValidationException if the updated document does not
+            match the model structure
+        :raises: ManagerException with 409 status code if the document
+            version does not match.
+        """
+        query = self._get_query(lookup_keys)
+        updates = dict(updates)
+        for field in (self.id_field, '_id'):
+            updates.pop(field, None)
+        expected_version = updates.pop(self.version_field, None) \
+            if self.version_field else None
+
+        stored = self._find_one(query)
+        if stored is None:
+            raise NotFoundException('No document found for %s' % lookup_keys)
+        if self.version_field and expected_version is None:
+            expected_version = stored.get(self.version_field)
+
+        if kwargs.get('full', False):
+            set_values, unset_values = self._get_full_diff(stored, updates)
+        else:
+            set_values, unset_values = self._get_patch_diff(stored, updates)
+
+        if not set_values and not unset_values:
+            return self._serialize_model(stored)
+
+        modifiers = {}
+        if set_values:
+            modifiers['$set'] = set_values
+        if unset_values:
+            modifiers['$unset'] = unset_values
+        guarded_query = dict(query)
+        if self.version_field:
+            modifiers['$inc'] = {self.version_field: 1}
+            guarded_query[self.version_field] = expected_version
+
+        model_document = self._find_and_modify(guarded_query, modifiers, new=True,
+                                                fields=self._get_projection())
+        if model_document is None:
+            if guarded_query != query and self._find_one(query, fields=['_id']):
+                raise ManagerException('The document was modified by another request',
+                                       status_code=409)
+            raise NotFoundException('No document found for %s' % lookup_keys)
+        return self._serialize_model(model_document)
 
-        return model_list
+    def _get_patch_diff(self, stored, updates):
+        """
+        Computes the $set values of a partial update.
+
+        :param stored: stored MongoKit document, modified in place
+        :param dict updates: the fields to update and their new values
+        :return: tuple(dict, dict): $set and $unset values
+        """
+        set_values = {}
+        for key, value in six.iteritems(updates):
+            if key not in stored or stored[key] != value:
+                set_values[key] = value
+        return self._validate_diff(stored, set_values, {})
+
+    def _get_full_diff(self, stored, updates):
+        """
+        Computes the $set and $unset values that turn the stored document
+        into the full update. Model structure fields missing from the
+        update are set to None, other fields are removed. The id, version
+        and excluded fields are never touched.
+
+        :param stored: stored MongoKit document, modified in place
+        :param dict updates: the full new state of the document
+        :return: tuple(dict, dict): $set and $unset values
+        """
+        protected = set(self.exclude_fields) | set(['_id', self.version_field])
+        set_values = {}
+        unset_values = {}
+        for key, value in six.iteritems(updates):
+            if key not in stored or stored[key] != value:
+                set_values[key] = value
+        for key in list(stored):
+            if key in updates or key in protected:
+                continue
+            if key in stored.structure:
+                if stored[key] is not None:
+                    set_values[key] = None
+            else:
+                unset_values[key] = ''
+        return self._validate_diff(stored, set_values, unset_values)
+
+    def _validate_diff(self, stored, set_values, unset_values):
+        """
+        Applies the diff to the stored document and validates the result
+        against the model the same way save() does. The $set values are
+        taken from the document after the custom types are converted.
+
+        :param stored: stored MongoKit document, modified in place
+        :param dict set_values: $set values
+        :param dict unset_values: $unset values
+        :return: tuple(dict, dict): $set and $unset values
+        :raises: ValidationException if the document is not valid
+        """
+        stored.update(set_values)
+        for key in unset_values:
+            del stored[key]
+        try:
+            if not stored.skip_validation:
+                stored.validate()
+            stored._process_custom_type('bson', stored, stored.structure)
+        except (SchemaDocumentError, MaxDocumentSizeError) as e:
+            raise ValidationException(six.text_type(e))
+        set_values = dict((key, copy.deepcopy(stored[key])) for key in set_values)
+        stored._process_custom_type('python', stored, stored.structure)
+        return set_values, unset_values
+
+    def _get_projection(self):
+        """
+        :return: projection that leaves the excluded fields out of the
+            results, None if all fields are returned.
+        """
+        if self.all_fields:
+            return None
+        return dict((field, False) for field in self.exclude_fields)
 
+    @_guard
     def delete(self, lookup_keys, *args, **kwargs):
         """
         Deletes objects from the database.
@@ -342,8 +801,126 @@ class MongoKitManager(six.with_metaclass(abc.ABCMeta, BaseManager)):
         :return: dict
         """
         query = self._get_query(lookup_keys)
-        documents = self.collection.find(query)
+        documents = self._find(query)
         for doc in documents:
             doc.delete()
 
         return {}
+
+    def _get_export_bounds(self, partitions):
+        """
+        Gets split points of roughly the same size from the partition
+        field index with the splitVector command, without reading the
+        documents. The split points cover the whole collection, the
+        filter is applied by the range queries. They all have the type
+        of the greatest one, values of other types are left to the
+        catch-all range.
+
+        :param int partitions: number of ranges
+        :return: list: split points, empty if the collection can not be
+            split and is exported as a single range.
+        """
+        field = self.export_partition_field
+        collection = self.collection.collection
+        database = collection.database
+        try:
+            size = database.command('collstats', collection.name).get('size', 0)
+            if partitions < 2 or not size:
+                return []
+            result = database.command('splitVector', collection.full_name,
+                                      keyPattern={field: 1},
+                                      maxChunkSizeBytes=max(int(size // partitions), 1))
+        except OperationFailure as e:
+            _logger.warning('Can not split %s on %s, exporting a single range: %s',
+                            collection.full_name, field, e)
+            return []
+
+        candidates = [key.get(field) for key in result.get('splitKeys', [])]
+        candidates = [value for value in candidates if value is not None]
+        if not candidates:
+            return []
+
+        split_points = []
+        for value in candidates:
+            if type(value) is type(candidates[-1]) and \
+                    (not split_points or value != split_points[-1]):
+                split_points.append(value)
+        return split_points
+
+    def export(self, filters, output, processes=None, partitions=None,
+               ordered=True, *args, **kwargs):
+        """
+        Exports the filtered collection as NDJSON using a process pool.
+        The collection is split into export_partition_field ranges and
+        every range is read and serialized by a worker with its own
+        connection. The manager class must be importable by the workers.
+        Documents whose partition field is null, missing or of another
+        type than the split points are exported by a last, catch-all
+        worker.
+
+        :param dict filters: query filters.
+        :param output: a file path, a writable text stream or a directory.
+            For a directory every range is kept in its own
+            part-<n>.ndjson file.
+        :param int processes: number of worker processes, defaults to
+            the number of cores.
+        :param int partitions: number of ranges, defaults to four per
+            worker process.
+        :param bool ordered: if False ranges are written as soon as
+            they are ready instead of in partition field order.
+        :param kwargs: if kwargs dict contains a 'query' argument it is
+            treated as ready MongoDB query dict.
+        :return: int: number of exported documents
+        """
+        query = self._get_query(filters)
+        if 'query' in kwargs:
+            query.update(kwargs['query'])
+        processes = processes or cpu_count()
+        partitions = partitions or processes * 4
+
+        is_directory = isinstance(output, six.string_types) and os.path.isdir(output)
+        directory = output if is_directory else tempfile.mkdtemp()
+
+        field = self.export_partition_field
+        split_points = self._get_export_bounds(partitions)
+        queries = [get_range_query(query, field, lower, upper) for lower, upper
+                   in zip([None] + split_points, split_points + [None])]
+        if split_points:
+            queries.append(get_other_types_query(query, field, split_points[0]))
+
+        if self.export_connection_uri:
+            uri, options = self.export_connection_uri, self.export_connection_options or {}
+        else:
+            _logger.warning('export_connection_uri is not set, export workers connect to '
+                            '%s:%s without any other connection option',
+                            self.connection.host, self.connection.port)
+            uri, options = self.connection.host, dict(port=self.connection.port)
+
+        tasks = []
+        for number, range_query in enumerate(queries):
+            path = os.path.join(directory, 'part-%05d.ndjson' % number)
+            tasks.append((type(self), uri, options, range_query, path))
+
+        pool = Pool(processes)
+        try:
+            results = pool.imap(export_partition, tasks) if ordered \
+                else pool.imap_unordered(export_partition, tasks)
+            if is_directory:
+                return sum(count for path, count in results)
+            if isinstance(output, six.string_types):
+                with io.open(output, 'w', encoding='utf-8') as stream:
+                    return self._concat_export(results, stream)
+            return self._concat_export(results, output)
+        finally:
+            pool.terminate()
+            if not is_directory:
+                shutil.rmtree(directory, ignore_errors=True)
+
+    @staticmethod
+    def _concat_export(results, stream):
+        total = 0
+        for path, count in results:
+            with io.open(path, 'r', encoding='utf-8') as part:
+                shutil.copyfileobj(part, stream)
+            total += count
+        return total
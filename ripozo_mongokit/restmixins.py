@@ -50,6 +50,18 @@ class RetrievePageList(restmixins.RetrieveList):
         }
     }
 
+    The compact representation is selected with the "compact=rows" or
+    "compact=columns" query arg or the "compact" Accept header parameter,
+    e.g. "Accept: application/json; compact=rows". The field names are
+    returned once and the entities as positional arrays:
+
+    {
+        "page": {...},
+        "_links": {...},
+        "fields": ["id", "name", "age"],
+        "rows": [["5734d1b2...", "John Doe", 45]]
+    }
+
     """
 
     @apimethod(methods=['GET'], no_pks=True)
@@ -65,22 +77,47 @@ class RetrievePageList(restmixins.RetrieveList):
         :rtype: RetrieveList
         """
         _logger.debug('Retrieving list of resources using manager %s', cls.manager)
-        props, meta = cls.manager.retrieve_list(request.query_args)
+        props, meta = cls.manager.retrieve_list(request.query_args,
+                                                compact=cls._get_compact_format(request))
         if 'page_object' in props and 'data' in props:
-            return_props = {cls.resource_name: props['data']}
+            if isinstance(props['data'], dict):
+                return_props = dict(props['data'])
+            else:
+                return_props = {cls.resource_name: props['data']}
             return_props.update(props['page_object'])
             return cls(properties=return_props, meta=meta,
                        status_code=200, query_args=cls.manager.fields, no_pks=True)
         else:
             return super(RetrievePageList, cls).retrieve_list(cls, request)
 
+    @staticmethod
+    def _get_compact_format(request):
+        """
+        Finds the "compact" parameter of the Accept header.
+
+        :param RequestContainer request: The request in the standardized
+            ripozo style.
+        :return: the compact format or None
+        """
+        headers = request.headers
+        accept = headers.get('Accept') or headers.get('accept') or ''
+        for media_range in accept.split(','):
+            for param in media_range.split(';')[1:]:
+                name, _, value = param.partition('=')
+                if name.strip() == 'compact':
+                    return value.strip().strip('"')
+        return None
+
 
 @export_name
 class FullUpdate(Update):
     """
-    Registers PUT full updates to the resource.
+    Registers PUT full updates to the resource. The request body is the
+    full new state of the resource, fields missing from it are removed.
     """
     @apimethod(methods=['PUT'])
     @manager_translate(fields_attr='update_fields', validate=True, skip_required=True)
     def full_update(cls, request):
-        return Update.update(cls, request)
+        _logger.debug('Fully updating a resource using the manager %s', cls.manager)
+        props = cls.manager.update(request.url_params, request.body_args, full=True)
+        return cls(properties=props, status_code=200)
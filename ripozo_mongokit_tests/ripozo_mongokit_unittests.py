@@ -3,12 +3,25 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import io
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+
 import unittest2 as test
 from bson.objectid import ObjectId
-from mock import Mock, MagicMock
+from mock import Mock, MagicMock, patch
+from pymongo.errors import DuplicateKeyError, ExecutionTimeout, OperationFailure
+from ripozo.exceptions import ManagerException, NotFoundException, ValidationException
+from ripozo.resources.request import RequestContainer
 
-from ripozo_mongokit import MongoKitManager
+from ripozo_mongokit import MongoKitManager, GroupCommitWriter, RetrievePageList
+from ripozo_mongokit.export import export_partition
 from mongokit import Document, Connection
+from mongokit.schema_document import RequireFieldError, SchemaTypeError
 
 
 class Manager(MongoKitManager):
@@ -17,6 +30,27 @@ class Manager(MongoKitManager):
     exclude_fields = ('name',)
 
 
+class StoredDocument(dict):
+    """
+    Stored MongoKit document stand-in for the update tests
+    """
+    structure = {'name': basestring, 'age': int}
+    skip_validation = False
+
+    def __init__(self, *args, **kwargs):
+        super(StoredDocument, self).__init__(*args, **kwargs)
+        self.validated = False
+        self.error = None
+
+    def validate(self):
+        self.validated = True
+        if self.error:
+            raise self.error
+
+    def _process_custom_type(self, target, doc, struct):
+        pass
+
+
 class MongoKitManagerTests(test.TestCase):
     """
     Tests for all MongoKitManager CRUDL methods
@@ -29,6 +63,23 @@ class MongoKitManagerTests(test.TestCase):
         self.model_cls.__name__ = 'Model'
         Manager.model = self.model_cls
 
+    def _related_fixtures(self):
+        """
+        :return: tuple: a connection serving both the model and a related
+            model, the related collection mock and a manager of the
+            related model.
+        """
+        related_collection = MagicMock()
+        connection = MagicMock(Model=self.collection, Related=related_collection,
+                               spec=Connection)
+        related_model = MagicMock(spec=Document, structure={'title': basestring})
+        related_model.__name__ = 'Related'
+
+        class RelatedManager(MongoKitManager):
+            model = related_model
+
+        return connection, related_collection, RelatedManager
+
     def test_default_init(self):
         Manager(connection=self.connection)
         self.connection.register.assert_called_once_with([Manager.model])
@@ -58,6 +109,22 @@ class MongoKitManagerTests(test.TestCase):
         self.collection.from_json.assert_called_once_with('{"name": "Joe"}')
         document.save.assert_called_once()
 
+    def test_create_group_commit(self):
+        class GroupCommitManager(Manager):
+            group_commit = True
+            group_commit_write_concern = {'w': 1}
+
+        manager = GroupCommitManager(connection=self.connection)
+        self.assertEqual(manager.writer.write_concern, {'w': 1})
+        document = MagicMock(skip_validation=False)
+        self.collection.from_json.return_value = document
+        manager.writer = Mock()
+        manager.create({'name': 'Joe'})
+
+        document.validate.assert_called_once_with()
+        document.save.assert_not_called()
+        manager.writer.write.assert_called_once_with(document)
+
     def test_retrieve(self):
         manager = Manager(connection=self.connection)
         self.assertEqual('a', manager._get_query('a'))
@@ -205,23 +272,322 @@ class MongoKitManagerTests(test.TestCase):
 
         self.assertEqual(manager.retrieve_list(filters, query=query), anticipated_return)
 
+    def test_prefetch(self):
+        connection, related_collection, RelatedManager = self._related_fixtures()
+
+        class PrefetchManager(MongoKitManager):
+            model = self.model_cls
+            id_field = 'id'
+            prefetch_relationships = {'related': ('related_id', RelatedManager)}
+
+        manager = PrefetchManager(connection=connection)
+
+        objs = [{
+            '_id': ObjectId('123456789012123456789011'),
+            'related_id': ObjectId('223456789012123456789011')
+        }, {
+            '_id': ObjectId('123456789012123456789012'),
+            'related_id': ObjectId('223456789012123456789011')
+        }, {
+            '_id': ObjectId('123456789012123456789013'),
+            'related_id': None
+        }]
+        cursor = Mock()
+        cursor.__iter__ = Mock(return_value=iter(objs))
+        cursor.count.return_value = len(objs)
+        self.collection.find.return_value = cursor
+
+        related_cursor = MagicMock()
+        related_cursor.__iter__.return_value = [{
+            '_id': ObjectId('223456789012123456789011'),
+            'title': 'Related'
+        }]
+        related_collection.find.return_value = related_cursor
+
+        values, meta = manager.retrieve_all({})
+
+        related_cursor.max_time_ms.assert_not_called()
+        related_collection.find.assert_called_once_with(
+            {'_id': {'$in': [ObjectId('223456789012123456789011')]}})
+        related = {'_id': '223456789012123456789011', 'title': 'Related'}
+        self.assertEqual([v.get('related') for v in values], [related, related, None])
+        self.assertEqual(meta, dict(count=3))
+
+        related_manager = manager._get_related_manager(RelatedManager)
+        related_collection.find.reset_mock()
+        related_cursor.__iter__.return_value = [{'_id': 5, 'title': 'Five'}]
+        self.assertEqual(related_manager.retrieve_by_keys([5]),
+                         {'5': {'_id': '5', 'title': 'Five'}})
+        related_collection.find.assert_called_once_with({'_id': {'$in': [5]}})
+
+        # The prefetch query runs within the budget of the list operation
+        cursor.__iter__ = Mock(return_value=iter([dict(obj) for obj in objs]))
+        cursor.max_time_ms.return_value = cursor
+        related_cursor.max_time_ms.return_value = related_cursor
+        related_cursor.__iter__.return_value = [{'_id': ObjectId('223456789012123456789011')}]
+        manager.retrieve_all({}, max_time_ms=250)
+        related_cursor.max_time_ms.assert_called_once_with(250)
+
+    def test_export(self):
+        manager = Manager(connection=self.connection)
+        manager.export_connection_uri = 'mongodb://user:secret@h1,h2/?replicaSet=rs'
+        manager.export_connection_options = {'ssl': True}
+        objs = [{'_id': n, 'age': n} for n in range(5)] + \
+            [{'_id': 'x', 'age': 5}, {'_id': None, 'age': 6}]
+
+        class Cursor(list):
+            def count(self):
+                return len(self)
+
+        def in_range(obj, bounds):
+            return isinstance(obj['_id'], int) and \
+                obj['_id'] >= bounds.get('$gte', obj['_id']) and \
+                obj['_id'] < bounds.get('$lt', obj['_id'] + 1)
+
+        def find(query, fields=None, sort=None):
+            if '$nor' in query:
+                found = [obj for obj in objs
+                         if not any(in_range(obj, cond['_id']) for cond in query['$nor'])]
+            elif '_id' in query:
+                found = [obj for obj in objs if in_range(obj, query['_id'])]
+            else:
+                found = objs
+            if sort:
+                found = sorted(found, key=lambda obj: obj[sort[0][0]])
+            return Cursor(dict(obj) for obj in found)
+
+        self.collection.find.side_effect = find
+        raw_collection = self.collection.collection
+        raw_collection.name = 'models'
+        raw_collection.full_name = 'db.models'
+
+        def command(name, value, **kwargs):
+            if name == 'collstats':
+                return {'size': 700}
+            return {'splitKeys': [{'_id': 'y'}, {'_id': 3}]}
+
+        raw_collection.database.command.side_effect = command
+
+        pool = Mock()
+        pool.imap.side_effect = lambda fn, tasks: [fn(task) for task in tasks]
+        stream = io.StringIO()
+        with patch('ripozo_mongokit.mongokitmanager.Pool', return_value=pool), \
+                patch('ripozo_mongokit.export.Connection',
+                      return_value=self.connection) as connection:
+            count = manager.export({}, stream, processes=2, partitions=2)
+
+        self.assertEqual(count, 7)
+        self.assertEqual([json.loads(line)['age'] for line in stream.getvalue().splitlines()],
+                         list(range(7)))
+        self.assertEqual([task[3] for task in pool.imap.call_args[0][1]],
+                         [{'_id': {'$lt': 3}}, {'_id': {'$gte': 3}},
+                          {'$nor': [{'_id': {'$gte': 3}}, {'_id': {'$lt': 3}}]}])
+        connection.assert_called_with(manager.export_connection_uri, ssl=True)
+        pool.terminate.assert_called_once_with()
+        # The split points come from the index, no document is read for them
+        raw_collection.find.assert_not_called()
+        raw_collection.database.command.assert_called_with(
+            'splitVector', 'db.models', keyPattern={'_id': 1}, maxChunkSizeBytes=350)
+
+    def test_export_bounds_unsupported(self):
+        manager = Manager(connection=self.connection)
+        self.collection.collection.database.command.side_effect = \
+            OperationFailure('splitVector is not allowed')
+        self.assertEqual(manager._get_export_bounds(4), [])
+        self.collection.collection.find.assert_not_called()
+
+    def test_export_task(self):
+        path = os.path.join(tempfile.mkdtemp(), 'part-00000.ndjson')
+        task = pickle.loads(pickle.dumps((Manager, 'mongodb://h1,h2/?replicaSet=rs',
+                                          {'ssl': True}, {'age': 5}, path)))
+        self.collection.find.return_value = [{'_id': 'a', 'age': 5}]
+
+        with patch('ripozo_mongokit.export.Connection',
+                   return_value=self.connection) as connection:
+            self.assertEqual(export_partition(task), (path, 1))
+
+        connection.assert_called_once_with('mongodb://h1,h2/?replicaSet=rs', ssl=True)
+        self.collection.find.assert_called_once_with({'age': 5})
+        with io.open(path, encoding='utf-8') as part:
+            self.assertEqual(json.loads(part.read()), {'id': 'a', 'age': 5})
+        shutil.rmtree(os.path.dirname(path))
+
+    def test_retrieve_list_compact(self):
+        class CompactManager(Manager):
+            model = self.model_cls
+            exclude_fields = ('password',)
+
+        self.model_cls.structure = {'name': basestring, 'age': int, 'password': basestring}
+        manager = CompactManager(connection=self.connection)
+        objs = [{'_id': 'a', 'name': 'John', 'age': 45},
+                {'_id': 'b', 'name': 'Jim'}]
+
+        cursor = MagicMock()
+        cursor.count.return_value = 2
+        cursor.skip.return_value.limit.return_value = cursor
+        cursor.__iter__.side_effect = lambda: iter([dict(obj) for obj in objs])
+        self.collection.find.return_value = cursor
+
+        props, meta = manager.retrieve_list({manager.compact_query_arg: ['rows']})
+        self.collection.find.assert_called_once_with({}, fields=['age', 'name'])
+        self.assertEqual(props['data'], {'fields': ['id', 'age', 'name'],
+                                         'rows': [['a', 45, 'John'], ['b', None, 'Jim']]})
+        self.assertEqual(props['page_object']['page']['totalElements'], 2)
+
+        props, meta = manager.retrieve_list({}, compact='columns')
+        self.assertEqual(props['data'], {'fields': ['id', 'age', 'name'],
+                                         'columns': [['a', 'b'], [45, None], ['John', 'Jim']]})
+
+        with self.assertRaises(ValidationException):
+            manager.retrieve_list({manager.compact_query_arg: 'xml'})
+
+    def test_retrieve_list_compact_prefetch(self):
+        connection, related_collection, RelatedManager = self._related_fixtures()
+
+        class CompactManager(Manager):
+            model = self.model_cls
+            exclude_fields = ('owner_id',)
+            prefetch_relationships = {'owner': ('owner_id', RelatedManager)}
+
+        self.model_cls.structure = {'name': basestring}
+        manager = CompactManager(connection=connection)
+
+        cursor = MagicMock()
+        cursor.count.return_value = 1
+        cursor.skip.return_value.limit.return_value = cursor
+        cursor.__iter__.return_value = [{'_id': 'a', 'name': 'John', 'owner_id': 7}]
+        self.collection.find.return_value = cursor
+        related_cursor = MagicMock()
+        related_cursor.__iter__.return_value = [{'_id': 7, 'title': 'Owner'}]
+        related_collection.find.return_value = related_cursor
+
+        props, meta = manager.retrieve_list({}, compact='rows')
+
+        self.collection.find.assert_called_once_with({}, fields=['name', 'owner_id'])
+        related_collection.find.assert_called_once_with({'_id': {'$in': [7]}})
+        self.assertEqual(props['data'], {'fields': ['id', 'name', 'owner'],
+                                         'rows': [['a', 'John', {'_id': '7', 'title': 'Owner'}]]})
+
+    def test_compact_accept_header(self):
+        request = RequestContainer(
+            headers={'Accept': 'text/html, application/json; compact=columns'})
+        self.assertEqual(RetrievePageList._get_compact_format(request), 'columns')
+        request = RequestContainer(headers={'Accept': 'application/json'})
+        self.assertIsNone(RetrievePageList._get_compact_format(request))
+
     def test_update(self):
         manager = Manager(connection=self.connection)
-        doc = MagicMock()
-        doc.__iter__.return_value = [('name', 'John'), ('age', 77)]
-        data_list = MagicMock()
-        data_list.__iter__ = Mock(return_value=iter([doc, doc]))
-        self.collection.find.return_value = data_list
+        stored = StoredDocument({'_id': 'a', 'name': 'John', 'age': 55, 'city': 'NYC'})
+        self.collection.find_one.return_value = stored
+        self.collection.find_and_modify.return_value = {'_id': 'a', 'age': 77, 'city': 'NYC'}
+
+        updated = manager.update({'id': 'a'}, {'age': 77, 'city': 'NYC', 'id': 'x'})
+
+        self.collection.find_and_modify.assert_called_once_with(
+            {'_id': 'a'}, {'$set': {'age': 77}}, new=True, fields={'name': False})
+        self.assertTrue(stored.validated)
+        self.assertEqual(updated, {'id': 'a', 'age': 77, 'city': 'NYC'})
+
+        stored.error = SchemaTypeError('age must be an instance of int not unicode')
+        with self.assertRaises(ValidationException) as context:
+            manager.update({'id': 'a'}, {'age': 'abc'})
+        self.assertEqual(context.exception.status_code, 400)
+        self.collection.find_and_modify.assert_called_once()
+
+        self.collection.find_one.return_value = None
+        with self.assertRaises(NotFoundException):
+            manager.update({'id': 'a'}, {'age': 78})
+
+    def test_full_update(self):
+        class VersionedManager(Manager):
+            version_field = 'version'
+
+        manager = VersionedManager(connection=self.connection)
+        stored = StoredDocument({'_id': 'a', 'name': 'Joe', 'age': 55, 'city': 'NYC',
+                                 'version': 3})
+        self.collection.find_one.return_value = stored
+        self.collection.find_and_modify.return_value = {'_id': 'a', 'age': 56, 'version': 4}
+
+        updated = manager.update({'id': 'a'}, {'name': 'Joe', 'age': 56}, full=True)
+
+        self.collection.find_and_modify.assert_called_once_with(
+            {'_id': 'a', 'version': 3},
+            {'$set': {'age': 56}, '$unset': {'city': ''}, '$inc': {'version': 1}},
+            new=True, fields={'name': False})
+        self.assertTrue(stored.validated)
+        self.assertEqual(updated, {'id': 'a', 'age': 56, 'version': 4})
+
+        stored.error = RequireFieldError('age is required')
+        with self.assertRaises(ValidationException) as context:
+            manager.update({'id': 'a'}, {'name': 'Joe'}, full=True)
+        self.assertEqual(context.exception.status_code, 400)
+
+    def test_update_conflict(self):
+        class VersionedManager(Manager):
+            version_field = 'version'
+
+        manager = VersionedManager(connection=self.connection)
+        self.collection.find_and_modify.return_value = None
+        self.collection.find_one.return_value = StoredDocument({'_id': 'a', 'version': 3})
+
+        with self.assertRaises(ManagerException) as context:
+            manager.update({'id': 'a'}, {'age': 56, 'version': 2})
+        self.assertEqual(context.exception.status_code, 409)
+        self.collection.find_and_modify.assert_called_once_with(
+            {'_id': 'a', 'version': 2}, {'$set': {'age': 56}, '$inc': {'version': 1}},
+            new=True, fields={'name': False})
+
+    def test_time_budget(self):
+        class BudgetManager(Manager):
+            max_time_ms = 100
+            operation_max_time_ms = {'retrieve_all': 500}
+
+        manager = BudgetManager(connection=self.connection)
+        cursor = MagicMock()
+        cursor.__iter__.return_value = []
+        cursor.count.return_value = 0
+        find = Mock()
+        find.max_time_ms.return_value = cursor
+        self.collection.find.return_value = find
+
+        self.assertEqual(manager.retrieve_all({}), ([], dict(count=0)))
+        find.max_time_ms.assert_called_once_with(500)
+
+        manager.retrieve({'name': 'Joe'}, max_time_ms=50)
+        self.collection.find_one.assert_called_once_with({'name': 'Joe'}, max_time_ms=50)
 
-        updates = {'age': 77}
-        lookup_keys = {'name': 'John'}
+        self.collection.find_one.side_effect = ExecutionTimeout('timeout')
+        with self.assertRaises(ManagerException) as context:
+            manager.retrieve({'name': 'Joe'})
+        self.assertEqual(context.exception.status_code, 504)
+        self.assertEqual(self.collection.find_one.call_args[1], {'max_time_ms': 100})
 
-        updated = manager.update(lookup_keys, updates)
+    def test_load_shedding(self):
+        class LimitedManager(Manager):
+            max_concurrent_operations = 1
 
-        doc.update.assert_called_with(updates)
-        doc.save.assert_called()
+        class OtherLimitManager(Manager):
+            max_concurrent_operations = 2
 
-        self.assertEqual(updated, [doc, doc])
+        self.model_cls.__database__ = 'limits'
+        self.model_cls.__collection__ = 'shared'
+        manager = LimitedManager(connection=self.connection)
+        other = LimitedManager(connection=self.connection)
+        self.assertIs(manager._limiter, other._limiter)
+        with self.assertRaises(ValueError):
+            OtherLimitManager(connection=self.connection)
+
+        def find_one(*args, **kwargs):
+            with self.assertRaises(ManagerException) as context:
+                other.retrieve({'name': 'Jim'})
+            self.assertEqual(context.exception.status_code, 503)
+            return None
+
+        self.collection.find_one.side_effect = find_one
+        self.assertEqual(manager.retrieve({'name': 'Joe'}), {})
+        self.collection.find_one.side_effect = None
+        self.collection.find_one.return_value = None
+        self.assertEqual(other.retrieve({'name': 'Jim'}), {})
 
     def test_delete(self):
         manager = Manager(connection=self.connection)
@@ -233,3 +599,129 @@ class MongoKitManagerTests(test.TestCase):
         self.assertEquals(manager.delete({}), {})
 
         doc.delete.assert_called()
+
+
+class GroupCommitWriterTests(test.TestCase):
+    """
+    Tests for the GroupCommitWriter batching and error reporting
+    """
+    def _write_concurrently(self, writer, documents):
+        errors = {}
+
+        def write(doc):
+            try:
+                writer.write(doc)
+            except Exception as e:
+                errors[doc['n']] = e
+
+        threads = [threading.Thread(target=write, args=(doc,)) for doc in documents]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        writer.close()
+        return errors
+
+    def test_batch(self):
+        collection = Mock()
+        writer = GroupCommitWriter(collection, flush_interval=200, batch_size=5,
+                                   write_concern={'w': 1})
+        documents = [{'n': n} for n in range(5)]
+
+        self.assertEqual(self._write_concurrently(writer, documents), {})
+        collection.insert.assert_called_once()
+        inserted = collection.insert.call_args[0][0]
+        self.assertEqual(sorted(doc['n'] for doc in inserted), list(range(5)))
+        self.assertEqual(collection.insert.call_args[1], {'w': 1})
+        self.assertTrue(all('_id' in doc for doc in documents))
+
+    def test_partial_failure(self):
+        collection = Mock()
+        documents = [{'n': n} for n in range(3)]
+
+        def insert(docs, **kwargs):
+            if isinstance(docs, list):
+                raise DuplicateKeyError('batch')
+            if docs['n'] == 2:
+                raise DuplicateKeyError('single')
+
+        collection.insert.side_effect = insert
+        collection.find.side_effect = lambda *args, **kwargs: [
+            {'_id': doc['_id']} for doc in documents if doc['n'] == 0]
+
+        writer = GroupCommitWriter(collection, flush_interval=200, batch_size=3)
+        errors = self._write_concurrently(writer, documents)
+
+        self.assertEqual(list(errors), [2])
+        self.assertIsInstance(errors[2], DuplicateKeyError)
+        # The batch, then the documents that were not found one by one
+        self.assertEqual(collection.insert.call_count, 3)
+
+    def test_queue_full(self):
+        writer = GroupCommitWriter(Mock(), max_queue_size=1, queue_timeout=0.01)
+        writer._thread = Mock()
+        writer._queue.put(None)
+
+        with self.assertRaises(ManagerException) as context:
+            writer.write({'n': 0})
+        self.assertEqual(context.exception.status_code, 503)
+
+    def test_ack_timeout(self):
+        writer = GroupCommitWriter(Mock(), ack_timeout=0.01)
+        writer._thread = Mock()
+
+        with self.assertRaises(ManagerException) as context:
+            writer.write({'n': 0})
+        self.assertEqual(context.exception.status_code, 503)
+        self.assertEqual(GroupCommitWriter(Mock(), flush_interval=10,
+                                           write_concern={'wtimeout': 990}).ack_timeout, 6)
+
+    def test_ack_timeout_cancels(self):
+        collection = Mock()
+        writer = GroupCommitWriter(collection, ack_timeout=0.01)
+        writer._thread = Mock()
+
+        with self.assertRaises(ManagerException) as context:
+            writer.write({'n': 0})
+        self.assertEqual(context.exception.status_code, 503)
+
+        # The timed out document is dropped when its batch is flushed
+        writer._flush([writer._queue.get_nowait()])
+        collection.insert.assert_not_called()
+
+    def test_ack_timeout_in_flight(self):
+        collection = Mock()
+        inserting = threading.Event()
+        release = threading.Event()
+
+        def insert(docs, **kwargs):
+            inserting.set()
+            release.wait()
+
+        collection.insert.side_effect = insert
+        writer = GroupCommitWriter(collection, flush_interval=1, batch_size=1,
+                                   ack_timeout=0.05)
+        with self.assertRaises(ManagerException) as context:
+            writer.write({'n': 0})
+        self.assertTrue(inserting.is_set())
+        self.assertEqual(context.exception.status_code, 504)
+        release.set()
+        writer.close()
+        collection.insert.assert_called_once()
+
+    def test_closed(self):
+        collection = Mock()
+        writer = GroupCommitWriter(collection, flush_interval=1)
+        writer.write({'n': 0})
+        writer.close()
+
+        with self.assertRaises(ManagerException) as context:
+            writer.write({'n': 1})
+        self.assertEqual(context.exception.status_code, 503)
+        collection.insert.assert_called_once()
+
+        # A write queued behind the shutdown is rejected instead of hanging
+        pending = Mock()
+        writer._queue.put(pending)
+        writer._reject_queued()
+        self.assertEqual(pending.finish.call_args[0][0].status_code, 503)